@@ -7,11 +7,65 @@ import subprocess
 import sys
 from pathlib import Path
 import time
-import concurrent.futures
-import threading
+import asyncio
+import array
+import struct
+import tempfile
+import zlib
+import functools
+import json
+import shutil
 
-def detect_hardware_encoders():
-    """Detect available hardware encoders on the system"""
+# Where detected hardware encoders are remembered between runs
+ENCODER_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                  "dji-lut-applicator", "encoders.json")
+
+# Audio codecs that can be stream copied into an MP4 file
+MP4_AUDIO_CODECS = {"aac", "mp3", "ac3", "eac3", "alac", "opus", "flac"}
+
+# Number of values that follow each .cube keyword used by load_cube
+CUBE_KEYWORD_ARGS = {"LUT_3D_SIZE": 1, "DOMAIN_MIN": 3, "DOMAIN_MAX": 3, "LUT_3D_INPUT_RANGE": 2}
+
+# Keys of the dict returned by detect_hardware_encoders
+HARDWARE_ENCODERS = ('nvidia', 'amd', 'qsv', 'videotoolbox')
+
+def cache_per_ffmpeg_binary(func):
+    """Cache the result in ENCODER_CACHE_PATH until the ffmpeg binary changes, nothing is cached when func raises"""
+    @functools.wraps(func)
+    def wrapper():
+        # Key the cache on the ffmpeg binary found in PATH and its modification time
+        ffmpeg_path = shutil.which("ffmpeg")
+        try:
+            mtime = os.stat(ffmpeg_path).st_mtime_ns
+        except (OSError, TypeError):
+            return func()
+        
+        try:
+            with open(ENCODER_CACHE_PATH, encoding="utf-8") as f:
+                cache = json.load(f)
+            result = cache["result"]
+            # Ignore results from hand-edited or older cache files missing an encoder
+            if (cache["ffmpeg"] == ffmpeg_path and cache["mtime"] == mtime and
+                    isinstance(result, dict) and all(name in result for name in HARDWARE_ENCODERS)):
+                return result
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        
+        result = func()
+        try:
+            os.makedirs(os.path.dirname(ENCODER_CACHE_PATH), exist_ok=True)
+            with open(ENCODER_CACHE_PATH, "w", encoding="utf-8") as f:
+                json.dump({"ffmpeg": ffmpeg_path, "mtime": mtime, "result": result}, f)
+        except OSError:
+            # Caching is only an optimization
+            pass
+        return result
+    
+    return wrapper
+
+@cache_per_ffmpeg_binary
+def query_hardware_encoders():
+    """Ask ffmpeg which hardware encoders it supports, raises if ffmpeg can't be run"""
     encoders = {
         'nvidia': False,  # NVIDIA NVENC
         'amd': False,     # AMD AMF
@@ -19,64 +73,273 @@ def detect_hardware_encoders():
         'videotoolbox': False  # Apple VideoToolbox (Metal)
     }
     
-    try:
-        # Run ffmpeg to get encoder list
-        cmd = ["ffmpeg", "-encoders", "-hide_banner"]
-        output = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.STDOUT)
+    # Run ffmpeg to get encoder list
+    cmd = ["ffmpeg", "-encoders", "-hide_banner"]
+    output = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.STDOUT)
+    
+    # Check for each encoder
+    if " h264_nvenc " in output:
+        encoders['nvidia'] = True
+    if " h264_amf " in output:
+        encoders['amd'] = True
+    if " h264_qsv " in output:
+        encoders['qsv'] = True
+    if " h264_videotoolbox " in output:
+        encoders['videotoolbox'] = True
         
-        # Check for each encoder
-        if " h264_nvenc " in output:
-            encoders['nvidia'] = True
-        if " h264_amf " in output:
-            encoders['amd'] = True
-        if " h264_qsv " in output:
-            encoders['qsv'] = True
-        if " h264_videotoolbox " in output:
-            encoders['videotoolbox'] = True
-            
-        return encoders
-    except:
-        # If error occurs, return no encoders available
-        return encoders
+    return encoders
 
-def apply_lut_to_video(video_path, lut_path, output_dir, quality="medium", crf=23, hw_encoder=None, print_lock=None, task_id=0):
-    """Apply LUT to a single video"""
-    video_name = os.path.basename(video_path)
-    name, ext = os.path.splitext(video_name)
-    output_path = os.path.join(output_dir, f"{name}_LUT{ext}")
-    
-    # First, get video duration using ffprobe
-    duration_cmd = [
-        "ffprobe", "-v", "error", "-show_entries", "format=duration",
-        "-of", "default=noprint_wrappers=1:nokey=1", video_path
-    ]
-    
+def detect_hardware_encoders():
+    """Detect available hardware encoders on the system"""
     try:
-        video_duration = float(subprocess.check_output(duration_cmd, universal_newlines=True).strip())
-    except:
-        video_duration = 0
-    
-    # Base FFmpeg command
-    cmd = [
-        "ffmpeg", "-i", video_path,
-        "-vf", f"lut3d={lut_path}",
+        return query_hardware_encoders()
+    except Exception:
+        # If error occurs, return no encoders available, this result is not cached
+        return dict.fromkeys(HARDWARE_ENCODERS, False)
+
+def load_cube(lut_path):
+    """Read a .cube LUT and return (size, domain_min, domain_max, table)
+    
+    table is a flat list of floats holding one RGB triplet per grid point, red changing fastest.
+    """
+    with open(lut_path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    
+    size = 0
+    domain_min = [0.0, 0.0, 0.0]
+    domain_max = [1.0, 1.0, 1.0]
+    
+    # Keywords all come before the table, parse them line by line
+    pos = 0
+    while pos < len(text):
+        end = text.find("\n", pos)
+        if end == -1:
+            end = len(text)
+        parts = text[pos:end].split()
+        if parts and not parts[0].startswith("#"):
+            key = parts[0].upper()
+            if not key[0].isalpha():
+                break  # First table row
+            if len(parts) - 1 < CUBE_KEYWORD_ARGS.get(key, 0):
+                raise ValueError(f"{key} needs {CUBE_KEYWORD_ARGS[key]} value{'s' if CUBE_KEYWORD_ARGS[key] > 1 else ''}")
+            if key == "LUT_3D_SIZE":
+                size = int(parts[1])
+            elif key == "DOMAIN_MIN":
+                domain_min = [float(v) for v in parts[1:4]]
+            elif key == "DOMAIN_MAX":
+                domain_max = [float(v) for v in parts[1:4]]
+            elif key == "LUT_3D_INPUT_RANGE":
+                domain_min = [float(parts[1])] * 3
+                domain_max = [float(parts[2])] * 3
+            elif key == "LUT_1D_SIZE":
+                raise ValueError("1D LUTs are not supported")
+        pos = end + 1
+    
+    # Parse the whole table in one pass instead of line by line
+    body = text[pos:]
+    if "#" in body:
+        body = "\n".join(line.split("#", 1)[0] for line in body.splitlines())
+    table = list(map(float, body.split()))
+    
+    if size < 2:
+        raise ValueError("missing or invalid LUT_3D_SIZE")
+    if any(high <= low for low, high in zip(domain_min, domain_max)):
+        raise ValueError("DOMAIN_MAX must be greater than DOMAIN_MIN")
+    if len(table) != size ** 3 * 3:
+        raise ValueError(f"expected {size ** 3} entries, found {len(table) // 3}")
+    
+    return size, domain_min, domain_max, table
+
+def cube_to_hald(lut_path, level=8):
+    """Convert a .cube LUT to a 16-bit Hald CLUT PNG and return the temporary file path"""
+    size, domain_min, domain_max, table = load_cube(lut_path)
+    
+    # Position of each Hald grid point on the LUT grid, as (index, weight) per channel
+    hald_size = level * level
+    samples = []
+    for c in range(3):
+        axis = []
+        for i in range(hald_size):
+            u = (i / (hald_size - 1) - domain_min[c]) / (domain_max[c] - domain_min[c]) * (size - 1)
+            u = min(max(u, 0.0), size - 1)
+            i0 = min(int(u), size - 2)
+            axis.append((i0, u - i0))
+        samples.append(axis)
+    
+    # Trilinear interpolation done one axis at a time, blue planes first, then green rows, then red
+    plane_len = size * size * 3
+    row_len = size * 3
+    planes = []
+    for i0, w in samples[2]:
+        p0 = table[i0 * plane_len:(i0 + 1) * plane_len]
+        p1 = table[(i0 + 1) * plane_len:(i0 + 2) * plane_len]
+        planes.append([a + (b - a) * w for a, b in zip(p0, p1)])
+    
+    red_samples = [(i0 * 3, w) for i0, w in samples[0]]
+    values = array.array("H")
+    for plane in planes:
+        for i0, w in samples[1]:
+            r0 = plane[i0 * row_len:(i0 + 1) * row_len]
+            r1 = plane[(i0 + 1) * row_len:(i0 + 2) * row_len]
+            row = [a + (b - a) * w for a, b in zip(r0, r1)]
+            values.extend(
+                int(min(max(row[j + c] + (row[j + 3 + c] - row[j + c]) * w, 0.0), 1.0) * 65535 + 0.5)
+                for j, w in red_samples for c in (0, 1, 2)
+            )
+    
+    # PNG stores 16-bit samples big-endian
+    if sys.byteorder == "little":
+        values.byteswap()
+    data = values.tobytes()
+    
+    # Hald images are level^3 pixels square, red changes fastest like in .cube files
+    width = level ** 3
+    stride = width * 3 * 2
+    raw = b"".join(b"\x00" + data[y * stride:(y + 1) * stride] for y in range(width))
+    
+    def chunk(tag, payload):
+        return struct.pack(">I", len(payload)) + tag + payload + struct.pack(">I", zlib.crc32(tag + payload))
+    
+    fd, hald_path = tempfile.mkstemp(prefix="hald_", suffix=".png")
+    with os.fdopen(fd, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, width, 16, 2, 0, 0, 0)))  # 16-bit RGB
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
+    
+    return hald_path
+
+# Text of each line of the multi-line progress display, keyed by terminal line number
+_frame_state = {}
+_dirty_lines = set()
+_render_scheduled = False
+
+def update_line(task_line, text):
+    """Set the text of a progress display line, changed lines are redrawn together once per event loop iteration"""
+    global _render_scheduled
+    _frame_state[task_line] = text
+    _dirty_lines.add(task_line)
+    if not _render_scheduled:
+        _render_scheduled = True
+        asyncio.get_running_loop().call_soon(render_frame)
+
+def render_frame():
+    """Redraw all changed progress display lines with a single write"""
+    global _render_scheduled
+    _render_scheduled = False
+    if _dirty_lines:
+        # Move cursor to each changed line, clear it and write its text
+        sys.stdout.write("".join(f"\033[{line};0H\033[K{_frame_state[line]}" for line in sorted(_dirty_lines)))
+        sys.stdout.flush()
+        _dirty_lines.clear()
+
+def part_path(output_path):
+    """Temporary path an output is written to until its encode has finished"""
+    return output_path.with_name(f"{output_path.stem}.part{output_path.suffix}")
+
+def remove_part_files(jobs):
+    """Remove temporary outputs left by a failed encode"""
+    for _, output_path, _ in jobs:
+        try:
+            os.remove(part_path(output_path))
+        except OSError:
+            pass
+
+def group_name(jobs):
+    """Name shown for a group of jobs in progress output"""
+    video_name = jobs[0][2]
+    if len(jobs) > 1:
+        video_name += f" (+{len(jobs) - 1} more)"
+    return video_name
+
+async def probe_videos(video_files, max_workers=8):
+    """Get the duration and audio codecs of each video, running ffprobe calls in parallel"""
+    semaphore = asyncio.Semaphore(max_workers)
+    
+    async def probe(video_path):
+        cmd = [
+            "ffprobe", "-v", "error", "-show_entries", "format=duration:stream=codec_type,codec_name",
+            "-of", "json", str(video_path)
+        ]
+        info = {"duration": 0, "audio_codecs": []}
+        async with semaphore:
+            try:
+                process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+                output, _ = await process.communicate()
+                data = json.loads(output)
+                info["audio_codecs"] = [stream.get("codec_name") for stream in data.get("streams", [])
+                                        if stream.get("codec_type") == "audio"]
+                info["duration"] = float(data["format"]["duration"])
+            except Exception:
+                pass
+        return info
+    
+    infos = await asyncio.gather(*(probe(video_file) for video_file in video_files))
+    return dict(zip(video_files, infos))
+
+async def apply_lut_to_videos(jobs, hald_path, quality=None, crf=23, hw_encoder=None, task_id=None, threads=0, video_infos=None):
+    """Apply LUT to a group of (video_path, output_path, video_name) jobs using a single ffmpeg process"""
+    # Name shown in progress output
+    video_name = group_name(jobs)
+    
+    # Input options, these must come before each -i. The probe limits pin
+    # ffmpeg's current defaults so a future default change can't slow startup
+    input_args = [
+        "-probesize", "5M",
+        "-analyzeduration", "5M",
+        "-fflags", "+fastseek+discardcorrupt",
     ]
     
+    # Decode on the GPU when its encoder is used. lut3d only runs on the CPU,
+    # so decoded frames are copied back to system memory for the filter
+    if hw_encoder == 'nvidia':
+        input_args.extend(["-hwaccel", "cuda"])
+    elif hw_encoder == 'videotoolbox':
+        input_args.extend(["-hwaccel", "videotoolbox"])
+    
+    # Base FFmpeg command with every video as a separate input
+    cmd = ["ffmpeg", "-y"]  # Outputs left by an earlier run are overwritten
+    for video_path, _, _ in jobs:
+        cmd.extend(input_args + ["-i", str(video_path)])
+    
+    # The Hald CLUT image is the last input, split it so every video gets a copy
+    cmd.extend(["-i", hald_path])
+    hald_input = len(jobs)
+    filter_graph = f"[{hald_input}:v]split={len(jobs)}" + "".join(f"[h{i}]" for i in range(len(jobs)))
+    
+    # Apply the LUT to the main video stream of each input
+    filter_graph += "".join(f";[{i}:v:0][h{i}]haldclut[v{i}]" for i in range(len(jobs)))
+    cmd.extend([
+        "-filter_complex", filter_graph,
+        "-progress", "pipe:1",  # Output progress information
+    ])
+    
+    # Without an explicit preset, libx264 uses "faster", which is much quicker than
+    # "medium" with no visible quality loss at the same CRF. Hardware encoders keep "medium"
+    if quality is None:
+        quality = "medium" if hw_encoder else "faster"
+    
     # Add encoder settings based on hardware availability
+    encoder_args = []
     if hw_encoder == 'nvidia':
         # NVIDIA NVENC
-        cmd.extend([
+        encoder_args.extend([
             "-c:v", "h264_nvenc",
-            "-preset", "p4" if quality in ["veryslow", "slower", "slow"] else 
-                      "p2" if quality == "medium" else "p1",
+            "-preset", "p5" if quality in ["veryslow", "slower", "slow"] else 
+                      "p1" if quality in ["ultrafast", "superfast"] else "p4",
+            "-tune", "hq",
             "-profile:v", "high",
             "-rc", "vbr",
             "-cq", str(crf),
             "-b:v", "0",  # Use CQ mode
+            "-spatial-aq", "1",  # Spend bits on flat areas where banding shows
+            "-rc-lookahead", "32",
+            "-bf", "3",
+            "-multipass", "qres",  # Quarter resolution first pass, cheap on the GPU
         ])
     elif hw_encoder == 'amd':
         # AMD AMF
-        cmd.extend([
+        encoder_args.extend([
             "-c:v", "h264_amf",
             "-quality", "quality" if quality in ["veryslow", "slower", "slow", "medium"] else "speed",
             "-rc", "cqp",
@@ -85,7 +348,7 @@ def apply_lut_to_video(video_path, lut_path, output_dir, quality="medium", crf=2
         ])
     elif hw_encoder == 'qsv':
         # Intel QuickSync
-        cmd.extend([
+        encoder_args.extend([
             "-c:v", "h264_qsv",
             "-preset", "veryslow" if quality in ["veryslow", "slower"] else 
                        "slower" if quality == "slow" else 
@@ -94,163 +357,170 @@ def apply_lut_to_video(video_path, lut_path, output_dir, quality="medium", crf=2
         ])
     elif hw_encoder == 'videotoolbox':
         # Apple VideoToolbox (Metal)
-        cmd.extend([
+        encoder_args.extend([
             "-c:v", "h264_videotoolbox",
             "-q:v", str(max(1, min(100, (51-crf)*2))),  # Convert CRF to q value (1-100)
             "-allow_sw", "1",  # Allow software processing if needed
         ])
     else:
         # Software encoding (libx264)
-        cmd.extend([
+        encoder_args.extend([
             "-c:v", "libx264",
             "-crf", str(crf),
             "-preset", quality,
+            "-threads", str(threads),  # Share of the CPU cores given to this encode
         ])
     
     # Common settings for all encoders
-    cmd.extend([
+    encoder_args.extend([
         "-pix_fmt", "yuv420p",  # More compatible pixel format
-        "-c:a", "copy",
-        "-map", "0:v:0",  # Only map main video stream
-        "-map", "0:a?",   # Map audio if present
-        "-ignore_unknown", # Ignore unknown streams
-        "-progress", "pipe:1",  # Output progress information
-        output_path
     ])
     
-    # Use print_lock if provided
-    if print_lock:
-        with print_lock:
-            if hw_encoder:
-                print(f"[{video_name}] Hardware encoder: {hw_encoder}")
-            else:
-                print(f"[{video_name}] Software encoder (libx264)")
-    else:
-        if hw_encoder:
-            print(f"[{video_name}] Hardware encoder: {hw_encoder}")
+    # One output per input, each with its own encoder settings
+    for i, (_, output_path, _) in enumerate(jobs):
+        cmd.extend([
+            "-map", f"[v{i}]",  # Only map main video stream
+            "-map", f"{i}:a?",  # Map audio if present
+        ])
+        cmd.extend(encoder_args)
+        
+        # Copy audio unless the MP4 muxer can't store it (e.g. PCM), then fall back to AAC
+        audio_codecs = video_infos[i]["audio_codecs"] if video_infos else []
+        if output_path.suffix.lower() == ".mp4" and any(codec not in MP4_AUDIO_CODECS for codec in audio_codecs):
+            cmd.extend(["-c:a", "aac", "-b:a", "192k"])
         else:
-            print(f"[{video_name}] Software encoder (libx264)")
+            cmd.extend(["-c:a", "copy"])
+        
+        # Write to a temporary name so an interrupted encode never looks finished
+        cmd.append(str(part_path(output_path)))
+    
+    # Show encoder info on the task's line when running as part of a batch
+    encoder_str = f"Hardware encoder: {hw_encoder}" if hw_encoder else "Software encoder (libx264)"
+    if task_id is not None:
+        update_line(task_id, f"[{video_name}] {encoder_str}")
+    else:
+        print(f"[{video_name}] {encoder_str}")
     
     # Start the process
-    process = subprocess.Popen(
-        cmd, 
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
     )
     
-    # Variables to track progress
+    # Drain stderr in the background so a chatty ffmpeg never blocks on a full pipe
+    stderr_task = asyncio.ensure_future(process.stderr.read())
+    
+    # Variables to track progress, inputs are encoded side by side so the longest one sets the pace
+    video_duration = max(info["duration"] for info in video_infos) if video_infos else 0
     duration = video_duration if video_duration > 0 else None
     current_time = 0
     frame_count = 0
     total_frames = 0
     start_time = time.time()
-    last_update_time = start_time
     
-    # Process output in real-time to show progress
+    # Process output in real-time to show progress. Read whatever ffmpeg has written
+    # so far, which is normally a whole progress block, and split it into lines here
+    pending = b""
     while True:
-        line = process.stdout.readline()
-        if not line and process.poll() is not None:
+        chunk = await process.stdout.read(65536)
+        if not chunk:
             break
-            
-        # Parse progress information
-        if line.startswith("out_time_ms="):
-            try:
-                time_str = line.split("=")[1].strip()
-                if time_str != "N/A":
-                    current_time = int(time_str) / 1000000  # Convert to seconds
-            except (ValueError, IndexError):
-                pass
-        elif line.startswith("frame="):
-            try:
-                frame_str = line.split("=")[1].strip()
-                if frame_str != "N/A":
-                    frame_count = int(frame_str)
-            except (ValueError, IndexError):
-                pass
-        elif line.startswith("fps="):
-            try:
-                fps_str = line.split("=")[1].strip()
-                if fps_str != "N/A":
-                    current_fps = float(fps_str)
-            except (ValueError, IndexError):
-                current_fps = 0
-                
-        # Update progress display every 0.5 seconds
-        current_update_time = time.time()
-        if current_update_time - last_update_time >= 0.5:
-            last_update_time = current_update_time
-            elapsed = current_update_time - start_time
-            
-            # Calculate progress percentage
-            if duration and duration > 0 and current_time > 0:
-                progress = min(100, int(current_time / duration * 100))
-                
-                # Calculate ETA
-                if progress > 0:
-                    eta = (elapsed / progress) * (100 - progress)
-                    eta_str = f"ETA: {int(eta//60):02d}:{int(eta%60):02d}"
-                else:
-                    eta_str = "ETA: --:--"
-                
-                # Create progress bar
-                bar_length = 20
-                filled_length = progress // 5  # 每5%填充一个字符
-                progress_bar = f"[{'#' * filled_length}{' ' * (bar_length - filled_length)}]"
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()  # Keep an incomplete last line for the next read
+        
+        for line in lines:
+            # Parse progress information, kept as bytes since only a few keys are used
+            if line.startswith(b"out_time_ms="):
+                try:
+                    time_str = line[12:].strip()
+                    if time_str != b"N/A":
+                        current_time = int(time_str) / 1000000  # Convert to seconds
+                except ValueError:
+                    pass
+            elif line.startswith(b"frame="):
+                try:
+                    frame_str = line[6:].strip()
+                    if frame_str != b"N/A":
+                        frame_count = int(frame_str)
+                except ValueError:
+                    pass
+                    
+            # ffmpeg ends every progress block with "progress=", refresh the display once per block
+            if line.startswith(b"progress="):
+                elapsed = time.time() - start_time
                 
-                # Display progress information with lock and task_id for positioning
-                progress_str = f"{video_name}: {progress}% {progress_bar} Time: {int(elapsed//60):02d}:{int(elapsed%60):02d} {eta_str}"
+                # Calculate progress percentage
+                if duration and duration > 0 and current_time > 0:
+                    progress = min(100, int(current_time / duration * 100))
+                    
+                    # Calculate ETA
+                    if progress > 0:
+                        eta = (elapsed / progress) * (100 - progress)
+                        eta_str = f"ETA: {int(eta//60):02d}:{int(eta%60):02d}"
+                    else:
+                        eta_str = "ETA: --:--"
+                    
+                    # Create progress bar
+                    bar_length = 20
+                    filled_length = progress // 5  # 每5%填充一个字符
+                    progress_bar = f"[{'#' * filled_length}{' ' * (bar_length - filled_length)}]"
+                    
+                    # Display progress information with task_id for positioning
+                    progress_str = f"{video_name}: {progress}% {progress_bar} Time: {int(elapsed//60):02d}:{int(elapsed%60):02d} {eta_str}"
                 
-                if print_lock:
-                    with print_lock:
-                        # Move cursor to task's line and clear it
-                        sys.stdout.write(f"\033[{task_id};0H\033[K{progress_str}")
-                        sys.stdout.flush()
+                # If we don't have duration info, show frame count and processing speed
+                elif frame_count > 0:
+                    fps = frame_count / elapsed if elapsed > 0 else 0
+                    progress_str = f"{video_name}: Processed frames: {frame_count} | FPS: {fps:.2f} | Time: {int(elapsed//60):02d}:{int(elapsed%60):02d}"
                 else:
-                    sys.stdout.write(f"\r{progress_str}")
-                    sys.stdout.flush()
-            
-            # If we don't have duration info, show frame count and processing speed
-            elif frame_count > 0:
-                fps = frame_count / elapsed if elapsed > 0 else 0
-                progress_str = f"{video_name}: Processed frames: {frame_count} | FPS: {fps:.2f} | Time: {int(elapsed//60):02d}:{int(elapsed%60):02d}"
+                    continue
                 
-                if print_lock:
-                    with print_lock:
-                        # Move cursor to task's line and clear it
-                        sys.stdout.write(f"\033[{task_id};0H\033[K{progress_str}")
-                        sys.stdout.flush()
+                if task_id is not None:
+                    update_line(task_id, progress_str)
                 else:
                     sys.stdout.write(f"\r{progress_str}")
                     sys.stdout.flush()
     
     # Get the return code
-    return_code = process.poll()
+    return_code = await process.wait()
+    stderr = await stderr_task
     
     # Print final status
-    if print_lock:
-        with print_lock:
-            # Move cursor to task's line and clear it
-            sys.stdout.write(f"\033[{task_id};0H\033[K{video_name}: {'Completed' if return_code == 0 else 'Failed'}")
-            sys.stdout.flush()
+    if task_id is not None:
+        update_line(task_id, f"{video_name}: {'Completed' if return_code == 0 else 'Failed'}")
     else:
         print()
     
     # Check if there was an error
     if return_code != 0:
-        stderr = process.stderr.read()
-        if print_lock:
-            with print_lock:
-                print(f"\n\nError processing {video_name}:")
-                print(stderr)
+        if task_id is not None:
+            render_frame()
+            print(f"\n\nError processing {video_name}:")
         else:
             print(f"Error processing {video_name}:")
-            print(stderr)
+        print(stderr.decode(errors="replace"))
+        
+        remove_part_files(jobs)
         return None
     
-    return output_path
+    # Move finished outputs to their final names, this fails if ffmpeg wrote no output
+    # or, on Windows, if an old output is still open in another program
+    try:
+        for _, output_path, _ in jobs:
+            os.replace(part_path(output_path), output_path)
+    except OSError as e:
+        if task_id is not None:
+            render_frame()
+            print(f"\n\nError processing {video_name}: {e}")
+        else:
+            print(f"Error processing {video_name}: {e}")
+        remove_part_files(jobs)
+        return None
+    
+    return [output_path for _, output_path, _ in jobs]
 
-def process_directory(input_dir, lut_path, quality="medium", crf=23, max_workers=None, use_gpu=True):
+async def process_directory(input_dir, lut_path, quality=None, crf=23, max_workers=None, use_gpu=True, files_per_process=1, force=False):
     """Process all video files in the directory"""
     # Detect hardware encoders if GPU is enabled
     hw_encoder = None
@@ -274,91 +544,125 @@ def process_directory(input_dir, lut_path, quality="medium", crf=23, max_workers
         print("Hardware acceleration disabled, using CPU encoding")
     
     # Supported video formats
-    video_extensions = ['.mp4', '.mov', '.avi', '.mkv']
+    video_extensions = ('.mp4', '.mov', '.avi', '.mkv')
     
     # Output directory is the same as input directory
     output_dir = input_dir
     
-    # Get all video files
-    video_files = []
-    for ext in video_extensions:
-        video_files.extend(Path(input_dir).glob(f"*{ext}"))
-        video_files.extend(Path(input_dir).glob(f"*{ext.upper()}"))
+    # Get all video files in a single directory scan, extensions match case-insensitively
+    # Files produced by an earlier run are skipped so they don't get the LUT applied twice
+    with os.scandir(input_dir) as entries:
+        video_files = sorted(Path(entry.path) for entry in entries
+                             if entry.name.lower().endswith(video_extensions) and entry.is_file())
+    video_files = [p for p in video_files if not p.stem.endswith(("_LUT", "_LUT.part"))]
     
     if not video_files:
         print(f"No video files found in {input_dir}")
         return
     
+    # Build (video_path, output_path, video_name) jobs, outputs are written next to their source
+    jobs = [(p, p.with_name(f"{p.stem}_LUT{p.suffix}"), p.name) for p in video_files]
+    
+    # Skip videos whose output is already newer than the source, unless forced
+    if not force:
+        jobs = [(video_path, output_path, video_name) for video_path, output_path, video_name in jobs
+                if not output_path.exists() or output_path.stat().st_mtime < video_path.stat().st_mtime]
+        skipped_files = len(video_files) - len(jobs)
+        if skipped_files:
+            print(f"Skipping {skipped_files} already processed video files (use --force to re-encode them)")
+        if not jobs:
+            return
+    
     # Process each video file
     processed_files = []
     failed_files = []
     
-    total_files = len(video_files)
+    total_files = len(jobs)
     print(f"Found {total_files} video files to process")
     
+    # Group jobs so each ffmpeg process encodes several of them
+    job_groups = [jobs[i:i + files_per_process] for i in range(0, total_files, files_per_process)]
+    
     # Determine number of worker threads
     if max_workers is None:
         # Default to number of CPUs if not specified
         max_workers = os.cpu_count()
-    max_workers = min(max_workers, total_files)  # Don't use more workers than files
-    print(f"Using {max_workers} worker threads")
+    max_workers = min(max_workers, len(job_groups))  # Don't use more workers than groups
+    print(f"Using {max_workers} parallel workers")
+    
+    # Probe all videos up front instead of once per encode
+    video_infos = await probe_videos([video_path for video_path, _, _ in jobs])
     
-    # Create a lock for thread-safe printing
-    print_lock = threading.Lock()
+    # Convert the LUT once instead of having every ffmpeg process parse the .cube file
+    try:
+        hald_path = cube_to_hald(lut_path)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not read LUT file '{lut_path}': {e}")
+        return
     
     # Setup terminal for multi-line progress display
-    with print_lock:
-        # Clear screen and hide cursor
-        sys.stdout.write("\033[2J\033[H\033[?25l")
-        sys.stdout.flush()
-        
-        # Print header
-        print(f"Processing {total_files} video files with {max_workers} workers")
-        print("=" * 80)
-        
-        # Print empty lines for each task
-        for i in range(max_workers + 1):
-            print()
+    # Clear screen and hide cursor
+    sys.stdout.write("\033[2J\033[H\033[?25l")
+    sys.stdout.flush()
+    
+    # Print header
+    print(f"Processing {total_files} video files with {max_workers} workers")
+    print("=" * 80)
+    
+    # Print empty lines for each task
+    for i in range(max_workers + 1):
+        print()
+    
+    # Each running task holds one display line, which also caps concurrency at max_workers
+    free_lines = asyncio.Queue()
+    for i in range(max_workers):
+        free_lines.put_nowait(i + 3)  # +3 for header lines
+    
+    # Split the CPU cores between parallel encodes to avoid oversubscription
+    encoder_threads = max(1, (os.cpu_count() or 1) // (max_workers * files_per_process))
     
-    def process_video(video_file, file_index):
-        nonlocal processed_files, failed_files
-        video_name = os.path.basename(video_file)
+    async def process_video(job_group):
+        video_name = group_name(job_group)
         
-        # Assign a line number for this task (add offset for header lines)
-        task_line = (file_index % max_workers) + 3  # +3 for header lines
+        # Wait for a free line for this task
+        task_line = await free_lines.get()
         
-        with print_lock:
-            sys.stdout.write(f"\033[{task_line};0H\033[KStarting: {video_name}")
-            sys.stdout.flush()
+        update_line(task_line, f"Starting: {video_name}")
         
         start_time = time.time()
-        output_file = apply_lut_to_video(str(video_file), lut_path, output_dir, quality, crf, hw_encoder, print_lock, task_line)
+        try:
+            output_files = await apply_lut_to_videos(job_group, hald_path, quality, crf, hw_encoder, task_line,
+                                                     encoder_threads, [video_infos[video_path] for video_path, _, _ in job_group])
+        except OSError as e:
+            # Count the group as failed instead of stopping every other encode
+            render_frame()
+            print(f"\n\nError processing {video_name}: {e}")
+            output_files = None
+        finally:
+            free_lines.put_nowait(task_line)
         elapsed_time = time.time() - start_time
         
-        with print_lock:
-            # Move to task line and update with completion status
-            sys.stdout.write(f"\033[{task_line};0H\033[K{video_name}: {'Completed' if output_file else 'Failed'} in {elapsed_time:.1f} seconds")
-            sys.stdout.flush()
-            
-            # Move to summary line and update counts
-            summary_line = max_workers + 4
-            sys.stdout.write(f"\033[{summary_line};0H\033[KCompleted: {len(processed_files)}/{total_files} | Failed: {len(failed_files)}")
-            sys.stdout.flush()
-            
-            if output_file:
-                processed_files.append(output_file)
-            else:
-                failed_files.append(str(video_file))
-    
-    # Use ThreadPoolExecutor to process videos in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_video, video_file, i) for i, video_file in enumerate(video_files, 1)]
-        concurrent.futures.wait(futures)
-    
-    # Restore terminal and show cursor
-    with print_lock:
+        if output_files:
+            processed_files.extend(output_files)
+        else:
+            failed_files.extend(name for _, _, name in job_group)
+        
+        # Update task line with completion status
+        update_line(task_line, f"{video_name}: {'Completed' if output_files else 'Failed'} in {elapsed_time:.1f} seconds")
+        
+        # Update summary line with counts
+        summary_line = max_workers + 4
+        update_line(summary_line, f"Completed: {len(processed_files)}/{total_files} | Failed: {len(failed_files)}")
+    
+    # Run all groups on the event loop, at most max_workers ffmpeg processes at a time
+    try:
+        await asyncio.gather(*(process_video(job_group) for job_group in job_groups))
+    finally:
+        # Draw the last updates, then restore terminal and show cursor
+        render_frame()
         sys.stdout.write("\033[?25h")  # Show cursor
         sys.stdout.flush()
+        os.remove(hald_path)
     
     # Print final summary
     print("\n\nProcessing complete!")
@@ -366,7 +670,7 @@ def process_directory(input_dir, lut_path, quality="medium", crf=23, max_workers
     if failed_files:
         print(f"Failed to process: {len(failed_files)} files")
         for f in failed_files:
-            print(f" - {os.path.basename(f)}")
+            print(f" - {f}")
     
     print(f"Output files saved to: {output_dir}")
 
@@ -376,16 +680,20 @@ def main():
     parser.add_argument('lut_file', help='LUT file path (.cube format)')
     parser.add_argument('-q', '--quality', 
                         choices=['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow'],
-                        default='medium',
-                        help='Encoding quality/speed (default: medium)')
+                        default=None,
+                        help='Encoding quality/speed (default: faster for CPU encoding, medium for GPU encoders)')
     parser.add_argument('-c', '--crf', type=int, default=23, 
                         help='CRF value for quality (0-51, lower is better quality, default: 23)')
     parser.add_argument('-t', '--threads', type=int, default=None,
-                        help='Maximum number of parallel processing threads (default: CPU count)')
+                        help='Maximum number of parallel ffmpeg processes (default: CPU count)')
     parser.add_argument('-g', '--gpu', action='store_true', default=True,
                         help='Enable GPU acceleration if available (default: enabled)')
     parser.add_argument('--no-gpu', action='store_false', dest='gpu',
                         help='Disable GPU acceleration')
+    parser.add_argument('-n', '--files-per-process', type=int, default=1,
+                        help='Number of videos encoded by each ffmpeg process, higher values cut startup overhead for many short clips (default: 1)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Re-encode videos that already have an up-to-date _LUT output')
     
     args = parser.parse_args()
     
@@ -404,8 +712,23 @@ def main():
         print(f"Error: CRF value must be between 0 and 51")
         return
     
+    # Validate number of parallel processes
+    if args.threads is not None and args.threads < 1:
+        print(f"Error: Number of parallel processes must be at least 1")
+        return
+    
+    # Check that ffmpeg is installed
+    if not shutil.which("ffmpeg"):
+        print("Error: ffmpeg was not found in PATH, please install FFmpeg")
+        return
+    
+    # Validate files per process
+    if args.files_per_process < 1:
+        print(f"Error: Files per process must be at least 1")
+        return
+    
     # Process video files
-    process_directory(args.input_dir, args.lut_file, args.quality, args.crf, args.threads, args.gpu)
+    asyncio.run(process_directory(args.input_dir, args.lut_file, args.quality, args.crf, args.threads, args.gpu, args.files_per_process, args.force))
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file